@@ -26,9 +26,8 @@ logger = logging.getLogger(__name__)
 
 # ── Главное меню ─────────────────────────────────────────────────────────────
 
-async def get_admin_main_keyboard():
-    topic_mode = await db.get_topic_mode()
-    mode_text  = "📁 Отдельный топик для каждого" if topic_mode == TopicMode.PER_USER else "📂 Общий топик"
+def _build_admin_markup(topic_mode: str) -> InlineKeyboardMarkup:
+    mode_text = "📁 Отдельный топик для каждого" if topic_mode == TopicMode.PER_USER else "📂 Общий топик"
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("✏️ Изменить приветствие",  callback_data="admin_edit_greeting")],
         [InlineKeyboardButton("📝 Изменить информацию",   callback_data="admin_edit_help")],
@@ -38,12 +37,16 @@ async def get_admin_main_keyboard():
         [InlineKeyboardButton("❌ Закрыть",               callback_data="admin_close_menu")],
     ])
 
+# Меню отличается только режимом топиков, поэтому строим оба варианта заранее
+ADMIN_MARKUPS = {mode: _build_admin_markup(mode) for mode in TopicMode}
+
+def get_admin_main_keyboard() -> InlineKeyboardMarkup:
+    return ADMIN_MARKUPS.get(db.get_topic_mode(), ADMIN_MARKUPS[TopicMode.SINGLE_TOPIC])
+
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not db.is_admin(update.effective_user.id):
-        return
     msg = await update.message.reply_text(
         "⚙️ Управление ботом",
-        reply_markup=await get_admin_main_keyboard(),
+        reply_markup=get_admin_main_keyboard(),
     )
     context.user_data["admin_menu_message_id"] = msg.message_id
     context.user_data["admin_menu_chat_id"]    = msg.chat_id
@@ -76,7 +79,7 @@ async def show_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     menu_chat_id = context.user_data.get("admin_menu_chat_id")
 
     if menu_msg_id and menu_chat_id:
-        await _edit_menu(context, menu_chat_id, menu_msg_id, "⚙️ Управление ботом", await get_admin_main_keyboard())
+        await _edit_menu(context, menu_chat_id, menu_msg_id, "⚙️ Управление ботом", get_admin_main_keyboard())
 
     await _delete_back_button(context, menu_chat_id, context.user_data.get("back_button_message_id"))
     return ConversationHandler.END
@@ -89,9 +92,9 @@ async def show_work_hours_menu(update: Update, context: ContextTypes.DEFAULT_TYP
     if query:
         await query.answer()
 
-    enabled   = await db.get_setting("work_hours_enabled", "0") == "1"
-    work_time = await db.get_setting("work_hours_time", db.DEFAULT_WORK_TIME)
-    work_text = await db.get_setting("work_hours_text", db.DEFAULT_WORK_TEXT)
+    enabled   = db.get_setting("work_hours_enabled", "0") == "1"
+    work_time = db.get_setting("work_hours_time", db.DEFAULT_WORK_TIME)
+    work_text = db.get_setting("work_hours_text", db.DEFAULT_WORK_TEXT)
 
     text = (
         "🔶 <b>Режим работы</b>\n\n"
@@ -170,7 +173,7 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
     data = query.data
 
     if data == "admin_edit_greeting":
-        current = await db.get_setting("greeting", db.DEFAULT_GREETING)
+        current = db.get_setting("greeting", db.DEFAULT_GREETING)
         msg = await query.message.reply_text(
             f"👉 Введите новое приветствие:\n\n<b>Текущее:</b>\n\n{current}",
             parse_mode="HTML", reply_markup=back_markup,
@@ -179,7 +182,7 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
         return WAITING_GREETING
 
     elif data == "admin_edit_help":
-        current = await db.get_setting("help", db.DEFAULT_HELP)
+        current = db.get_setting("help", db.DEFAULT_HELP)
         msg = await query.message.reply_text(
             f"👉 Введите новое сообщение помощи:\n\n<b>Текущее:</b>\n\n{current}",
             parse_mode="HTML", reply_markup=back_markup,
@@ -188,11 +191,11 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
         return WAITING_HELP
 
     elif data == "admin_toggle_mode":
-        current  = await db.get_topic_mode()
+        current  = db.get_topic_mode()
         new_mode = TopicMode.SINGLE_TOPIC if current == TopicMode.PER_USER else TopicMode.PER_USER
         await db.set_topic_mode(new_mode)
         try:
-            await query.edit_message_reply_markup(reply_markup=await get_admin_main_keyboard())
+            await query.edit_message_reply_markup(reply_markup=get_admin_main_keyboard())
         except Exception:
             pass
 
@@ -200,7 +203,7 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
         return await show_work_hours_menu(update, context)
 
     elif data == "admin_toggle_work":
-        current = await db.get_setting("work_hours_enabled", "0")
+        current = db.get_setting("work_hours_enabled", "0")
         await db.set_setting("work_hours_enabled", "0" if current == "1" else "1")
         return await show_work_hours_menu(update, context)
 
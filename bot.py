@@ -1,24 +1,53 @@
+import asyncio
 import logging
-from datetime import datetime, timezone
-
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import logging.handlers
+import queue
+import re
+import time
+from collections import OrderedDict
+
+import orjson
+from telegram import (
+    Update,
+    Message,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    MessageEntity,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+)
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
+    SimpleUpdateProcessor,
     filters,
     ContextTypes,
     CallbackQueryHandler,
 )
+from telegram.request import HTTPXRequest
+
+try:
+    import uvloop
+except ImportError:  # uvloop недоступен на Windows
+    uvloop = None
 
 import database as db
 from database import TicketStatus, TopicMode
 from admin import admin_command, get_admin_conv_handler
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-)
+# Записи логов кладутся в очередь, а в консоль/файл их пишет отдельный поток,
+# чтобы вывод не блокировал event loop. Сообщение форматируется ещё в потоке
+# loop'а (QueueHandler.prepare), в фоновый поток уходит только запись.
+# Обработчик подключается в main() вместе с запуском _log_listener.
+_log_queue    = queue.SimpleQueue()
+_log_handler  = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("telegram").setLevel(logging.WARNING)
@@ -30,7 +59,7 @@ RATE_LIMIT_WINDOW   = 60  # за N секунд
 
 def _is_rate_limited(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
     """True если пользователь превысил лимит сообщений."""
-    now = datetime.now(timezone.utc).timestamp()
+    now = time.monotonic()
     key = f"rl_{user_id}"
     history: list = context.bot_data.get(key, [])
     # Оставляем только события в пределах окна
@@ -45,27 +74,44 @@ def _is_rate_limited(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
 
 # ── Создание тикета ──────────────────────────────────────────────────────────
 
+# ticket_id -> (topic_id, имя для названия топика); избавляет от чтения тикета
+# из БД при каждой смене статуса топика. Хранятся последние TICKET_META_SIZE
+# тикетов, остальные при необходимости перечитываются из БД.
+TICKET_META_SIZE = 1024
+TICKET_META: OrderedDict[int, tuple[int, str]] = OrderedDict()
+
+def _remember_ticket_meta(ticket_id: int, meta: tuple[int, str]):
+    TICKET_META[ticket_id] = meta
+    TICKET_META.move_to_end(ticket_id)
+    if len(TICKET_META) > TICKET_META_SIZE:
+        TICKET_META.popitem(last=False)
+
+def _topic_display_name(user_chat_id: int, username: str, first_name: str) -> str:
+    # Название топика ограничено 128 символами, два из них занимают эмодзи и пробел
+    return (username or first_name or f"User{user_chat_id}")[:126]
+
 async def create_ticket(
     context: ContextTypes.DEFAULT_TYPE,
     user_chat_id: int,
     username: str = None,
     first_name: str = None,
 ) -> tuple:
-    topic_mode = await db.get_topic_mode()
+    topic_mode = db.get_topic_mode()
     topic_id   = None
 
     if topic_mode == TopicMode.PER_USER:
-        display_name = username or first_name or f"User{user_chat_id}"
-        topic_name   = f"🟢 {display_name}"
+        display_name = _topic_display_name(user_chat_id, username, first_name)
         try:
             forum_topic = await context.bot.create_forum_topic(
-                chat_id=db.SUPPORT_CHAT_ID, name=topic_name[:128]
+                chat_id=db.SUPPORT_CHAT_ID, name=f"🟢 {display_name}"
             )
             topic_id = forum_topic.message_thread_id
         except Exception as e:
             logger.error(f"Ошибка создания топика: {e}")
 
     ticket_id = await db.create_ticket_in_db(user_chat_id, username, first_name, topic_id)
+    if topic_id:
+        _remember_ticket_meta(ticket_id, (topic_id, display_name))
 
     if topic_mode == TopicMode.PER_USER and topic_id:
         username_display = f"@{username}" if username else "Не указан"
@@ -76,47 +122,92 @@ async def create_ticket(
             f"📱 Username: {username_display}\n"
             f"🎫 Тикет: #{ticket_id}"
         )
-        try:
-            await context.bot.send_message(
-                chat_id=db.SUPPORT_CHAT_ID,
-                message_thread_id=topic_id,
-                text=user_info,
-                parse_mode="HTML",
-            )
-        except Exception as e:
-            logger.error(f"Ошибка отправки информации: {e}")
+        # Не ждём отправки: сообщение пользователя уходит в топик параллельно
+        context.application.create_task(_send_user_info(context, topic_id, user_info))
 
     return ticket_id, topic_id
 
 
-async def update_topic_status(
-    context: ContextTypes.DEFAULT_TYPE, ticket_id: int, status: str
-):
-    if await db.get_topic_mode() != TopicMode.PER_USER:
-        return
-    ticket_info = await db.get_ticket_info(ticket_id)
-    if not ticket_info or not ticket_info[0]:
-        return
-    topic_id, username, first_name, user_chat_id, *_ = ticket_info
-    emoji       = "🔴" if status == TicketStatus.CLOSED else "🟢"
-    display_name = username or first_name or f"User{user_chat_id}"
+async def _send_user_info(context: ContextTypes.DEFAULT_TYPE, topic_id: int, user_info: str):
+    try:
+        await context.bot.send_message(
+            chat_id=db.SUPPORT_CHAT_ID,
+            message_thread_id=topic_id,
+            text=user_info,
+            parse_mode="HTML",
+        )
+    except Exception as e:
+        logger.error(f"Ошибка отправки информации: {e}")
+
+
+async def update_topic_status(bot, ticket_id: int, status: str, ticket_info=None) -> bool:
+    """ticket_info — уже прочитанная строка get_ticket_info(), если есть.
+
+    Возвращает True, если был запрос edit_forum_topic к Telegram.
+    """
+    if db.get_topic_mode() != TopicMode.PER_USER:
+        return False
+    meta = TICKET_META.get(ticket_id)
+    if meta is None:
+        if ticket_info is None:
+            ticket_info = await db.get_ticket_info(ticket_id)
+        if not ticket_info or not ticket_info[0]:
+            return False
+        topic_id, username, first_name, user_chat_id, *_ = ticket_info
+        meta = (topic_id, _topic_display_name(user_chat_id, username, first_name))
+    _remember_ticket_meta(ticket_id, meta)
+    topic_id, display_name = meta
+    emoji = "🔴" if status == TicketStatus.CLOSED else "🟢"
     try:
-        await context.bot.edit_forum_topic(
+        await bot.edit_forum_topic(
             chat_id=db.SUPPORT_CHAT_ID,
             message_thread_id=topic_id,
-            name=f"{emoji} {display_name}"[:128],
+            name=f"{emoji} {display_name}",
         )
     except Exception as e:
         logger.error(f"Ошибка обновления названия топика: {e}")
+    return True
+
+
+# Смены статуса топиков идут через одну очередь: быстрые закрытия/открытия
+# одного тикета схлопываются в одну правку (важно только последнее состояние),
+# а правки в чате поддержки не превышают 20 в минуту.
+TOPIC_EDIT_INTERVAL = 3.0  # секунд между правками
+
+_topic_queue: asyncio.Queue = asyncio.Queue()
+_topic_worker_task: asyncio.Task | None = None
+
+def queue_topic_status(ticket_id: int, status: str, ticket_info=None):
+    _topic_queue.put_nowait((ticket_id, status, ticket_info))
+
+async def _topic_worker(application: Application):
+    while True:
+        ticket_id, status, ticket_info = await _topic_queue.get()
+        pending = {ticket_id: (status, ticket_info)}
+        while not _topic_queue.empty():
+            ticket_id, status, ticket_info = _topic_queue.get_nowait()
+            pending[ticket_id] = (status, ticket_info)
+        for ticket_id, (status, ticket_info) in pending.items():
+            try:
+                edited = await update_topic_status(application.bot, ticket_id, status, ticket_info)
+            except Exception as e:
+                logger.error(f"Ошибка обновления статуса топика тикета #{ticket_id}: {e}")
+                edited = False
+            # Пауза нужна только после реального запроса к Telegram
+            if edited:
+                await asyncio.sleep(TOPIC_EDIT_INTERVAL)
 
 
 # ── Клавиатуры ───────────────────────────────────────────────────────────────
 
-async def get_ticket_keyboard(user_chat_id: int, ticket_id: int) -> InlineKeyboardMarkup:
-    is_blocked  = await db.is_user_blocked(user_chat_id)
+async def get_ticket_keyboard(
+    user_chat_id: int, ticket_id: int, status: str = None
+) -> InlineKeyboardMarkup:
+    is_blocked  = db.is_user_blocked(user_chat_id)
     block_text  = "✅ Разблокировать" if is_blocked else "❌ Заблокировать"
-    ticket_info = await db.get_ticket_info(ticket_id)
-    status      = ticket_info[4] if ticket_info else TicketStatus.OPEN
+    if status is None:
+        ticket_info = await db.get_ticket_info(ticket_id)
+        status      = ticket_info[4] if ticket_info else TicketStatus.OPEN
 
     if status == TicketStatus.CLOSED:
         ticket_btn  = "🔓 Открыть тикет"
@@ -139,27 +230,161 @@ def rating_keyboard(ticket_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([buttons])
 
 
+# ── Пересылка содержимого ────────────────────────────────────────────────────
+
+# Вложения, которые пересылаются копированием исходного сообщения
+COPIED_MEDIA = ("photo", "video", "document", "voice", "audio")
+
+def _with_header(header: str, text: str, entities) -> tuple[str, list]:
+    """Добавляет header перед текстом, сдвигая разметку исходного текста."""
+    if not text:
+        return header, []
+    # Смещения сущностей считаются в UTF-16
+    shift = len(f"{header}\n\n".encode("utf-16-le")) // 2
+    shifted = [
+        MessageEntity(
+            type=e.type, offset=e.offset + shift, length=e.length, url=e.url,
+            user=e.user, language=e.language, custom_emoji_id=e.custom_emoji_id,
+        )
+        for e in entities
+    ]
+    return f"{header}\n\n{text}", shifted
+
+async def send_message_content(bot, message: Message, header: str = None, **send_kwargs):
+    """Отправляет текст или копию вложения сообщения, добавляя header перед текстом/подписью."""
+    if message.text and header:
+        text, entities = _with_header(header, message.text, message.entities)
+        return await bot.send_message(text=text, entities=entities, **send_kwargs)
+    if message.text or any(getattr(message, attr) for attr in COPIED_MEDIA):
+        # Без header подпись не передаём: copy_message сохранит исходную вместе с форматированием
+        if header:
+            send_kwargs["caption"], send_kwargs["caption_entities"] = _with_header(
+                header, message.caption, message.caption_entities
+            )
+        return await bot.copy_message(
+            from_chat_id=message.chat_id,
+            message_id=message.message_id,
+            **send_kwargs,
+        )
+    return None
+
+# Вложения, которые можно отправить одним альбомом
+ALBUM_MEDIA = {
+    "photo":    InputMediaPhoto,
+    "video":    InputMediaVideo,
+    "document": InputMediaDocument,
+    "audio":    InputMediaAudio,
+}
+
+async def send_album_content(bot, messages: list[Message], header: str = None, **send_kwargs):
+    """Отправляет альбом одним sendMediaGroup, header добавляется к подписи первого элемента.
+
+    Возвращает пары (исходное сообщение, отправленное). reply_markup не принимается:
+    у альбомов не бывает inline-клавиатуры.
+    """
+    originals, media = [], []
+    for message in messages:
+        item_cls = next((cls for attr, cls in ALBUM_MEDIA.items() if getattr(message, attr)), None)
+        if item_cls is None:
+            logger.warning(f"Пропущена часть альбома без поддерживаемого вложения: {message.message_id}")
+            continue
+        caption, entities = message.caption, message.caption_entities
+        if header and not media:
+            caption, entities = _with_header(header, caption, entities)
+        item_kwargs = {"caption": caption, "caption_entities": entities}
+        if item_cls in (InputMediaPhoto, InputMediaVideo):
+            item_kwargs["has_spoiler"] = message.has_media_spoiler
+        file_id = message.photo[-1].file_id if message.photo else message.effective_attachment.file_id
+        originals.append(message)
+        media.append(item_cls(media=file_id, **item_kwargs))
+    if not media:
+        return []
+    sent = await bot.send_media_group(media=media, **send_kwargs)
+    return list(zip(originals, sent))
+
+
 # ── Хендлеры пользователя ────────────────────────────────────────────────────
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if await db.is_user_blocked(update.effective_user.id):
+    if db.is_user_blocked(update.effective_user.id):
         return
-    await update.message.reply_text(await db.get_setting("greeting", db.DEFAULT_GREETING))
+    await update.message.reply_text(db.get_setting("greeting", db.DEFAULT_GREETING))
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if await db.is_user_blocked(update.effective_user.id):
+    if db.is_user_blocked(update.effective_user.id):
         return
-    await update.message.reply_text(await db.get_setting("help", db.DEFAULT_HELP))
+    await update.message.reply_text(db.get_setting("help", db.DEFAULT_HELP))
+
+# Сообщения одного пользователя пересылаются строго по очереди,
+# сообщения разных пользователей обрабатываются параллельно.
+USER_QUEUES: dict[int, asyncio.Queue] = {}
+USER_TASKS:  dict[int, asyncio.Task]  = {}
+
+# Части альбома приходят отдельными апдейтами: копим их ALBUM_DELAY секунд
+# и пересылаем одним элементом очереди. Место в очереди (future) занимается
+# по первой части, чтобы следующие сообщения пользователя не обогнали альбом.
+ALBUM_DELAY = 0.5
+_album_buffer: dict[str, list[Message]] = {}
 
 async def forward_to_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    message      = update.message
-    user         = message.from_user
-    user_chat_id = message.chat_id
+    message = update.message
+    if db.is_user_blocked(message.chat_id):
+        return
 
-    if await db.is_user_blocked(user_chat_id):
+    media_group_id = message.media_group_id
+    if media_group_id is None:
+        _enqueue_messages(context, message.chat_id, [message])
         return
+    album = _album_buffer.get(media_group_id)
+    if album is None:
+        album = _album_buffer[media_group_id] = []
+        loop   = asyncio.get_running_loop()
+        future = loop.create_future()
+        _enqueue_messages(context, message.chat_id, future)
+        loop.call_later(ALBUM_DELAY, _flush_album, media_group_id, future)
+    album.append(message)
+
+def _flush_album(media_group_id: str, future: asyncio.Future):
+    album = _album_buffer.pop(media_group_id)
+    future.set_result(sorted(album, key=lambda m: m.message_id))
+
+def _enqueue_messages(
+    context: ContextTypes.DEFAULT_TYPE,
+    user_chat_id: int,
+    messages: list[Message] | asyncio.Future,
+):
+    user_queue = USER_QUEUES.get(user_chat_id)
+    if user_queue is None:
+        user_queue = USER_QUEUES[user_chat_id] = asyncio.Queue()
+    user_queue.put_nowait(messages)
+    if user_chat_id not in USER_TASKS:
+        USER_TASKS[user_chat_id] = context.application.create_task(
+            _user_queue_worker(context, user_chat_id, user_queue)
+        )
 
-    # Rate limiting
+async def _user_queue_worker(
+    context: ContextTypes.DEFAULT_TYPE, user_chat_id: int, user_queue: asyncio.Queue
+):
+    try:
+        while not user_queue.empty():
+            messages = user_queue.get_nowait()
+            try:
+                if isinstance(messages, asyncio.Future):
+                    messages = await messages
+                await _forward_message(context, messages)
+            except Exception as e:
+                logger.error(f"Ошибка обработки сообщения пользователя {user_chat_id}: {e}")
+    finally:
+        del USER_QUEUES[user_chat_id]
+        del USER_TASKS[user_chat_id]
+
+async def _forward_message(context: ContextTypes.DEFAULT_TYPE, messages: list[Message]):
+    """Пересылает в поддержку одно сообщение или целый альбом."""
+    message      = messages[0]
+    user         = message.from_user
+    user_chat_id = message.chat_id
+
+    # Rate limiting (альбом считается одним сообщением)
     if _is_rate_limited(context, user_chat_id):
         await message.reply_text(
             f"⏳ Вы отправляете сообщения слишком часто. "
@@ -167,8 +392,8 @@ async def forward_to_support(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return
 
-    work_hours_enabled = await db.get_setting("work_hours_enabled", "0") == "1"
-    work_time          = await db.get_setting("work_hours_time", db.DEFAULT_WORK_TIME)
+    work_hours_enabled = db.get_setting("work_hours_enabled", "0") == "1"
+    work_time          = db.get_setting("work_hours_time", db.DEFAULT_WORK_TIME)
     ticket_data        = await db.get_open_ticket(user_chat_id)
     new_ticket         = False
 
@@ -179,7 +404,7 @@ async def forward_to_support(update: Update, context: ContextTypes.DEFAULT_TYPE)
         new_ticket   = True
         reply_text   = f"✅ Ваш тикет #{ticket_id} создан."
         if work_hours_enabled and not db.is_working_hours(work_time):
-            reply_text += f"\n\n{await db.get_setting('work_hours_text', db.DEFAULT_WORK_TEXT)}"
+            reply_text += f"\n\n{db.get_setting('work_hours_text', db.DEFAULT_WORK_TEXT)}"
         else:
             reply_text += " Оператор поддержки скоро ответит."
         await message.reply_text(reply_text)
@@ -187,7 +412,7 @@ async def forward_to_support(update: Update, context: ContextTypes.DEFAULT_TYPE)
         ticket_id, topic_id = ticket_data
 
     username   = f"@{user.username}" if user.username else "Не указан"
-    topic_mode = await db.get_topic_mode()
+    topic_mode = db.get_topic_mode()
 
     if topic_mode == TopicMode.SINGLE_TOPIC and new_ticket:
         header = (
@@ -202,56 +427,30 @@ async def forward_to_support(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     send_kwargs = {
         "chat_id":      db.SUPPORT_CHAT_ID,
-        "reply_markup": await get_ticket_keyboard(user_chat_id, ticket_id),
+        # Тикет только что найден открытым или создан, перечитывать статус не нужно
+        "reply_markup": await get_ticket_keyboard(user_chat_id, ticket_id, TicketStatus.OPEN),
     }
     if topic_mode == TopicMode.PER_USER and topic_id:
         send_kwargs["message_thread_id"] = topic_id
     elif topic_mode == TopicMode.SINGLE_TOPIC and db.SUPPORT_TOPIC_ID:
         send_kwargs["message_thread_id"] = db.SUPPORT_TOPIC_ID
 
-    sent_message = None
     try:
-        msg = message
-        if msg.photo:
-            cap = msg.caption or ""
-            sent_message = await context.bot.send_photo(
-                photo=msg.photo[-1].file_id,
-                caption=f"{header}\n\n{cap}" if cap else header,
-                **send_kwargs,
-            )
-        elif msg.video:
-            cap = msg.caption or ""
-            sent_message = await context.bot.send_video(
-                video=msg.video.file_id,
-                caption=f"{header}\n\n{cap}" if cap else header,
-                **send_kwargs,
-            )
-        elif msg.document:
-            cap = msg.caption or ""
-            sent_message = await context.bot.send_document(
-                document=msg.document.file_id,
-                caption=f"{header}\n\n{cap}" if cap else header,
-                **send_kwargs,
-            )
-        elif msg.voice:
-            sent_message = await context.bot.send_voice(
-                voice=msg.voice.file_id, caption=header, **send_kwargs
-            )
-        elif msg.audio:
-            cap = msg.caption or ""
-            sent_message = await context.bot.send_audio(
-                audio=msg.audio.file_id,
-                caption=f"{header}\n\n{cap}" if cap else header,
-                **send_kwargs,
-            )
-        elif msg.text:
-            sent_message = await context.bot.send_message(
-                text=f"{header}\n\n{msg.text}", **send_kwargs
-            )
-
-        if sent_message:
+        album_markup = None
+        if len(messages) > 1:
+            album_markup = send_kwargs.pop("reply_markup")
+            sent_pairs   = await send_album_content(context.bot, messages, header, **send_kwargs)
+        else:
+            sent_message = await send_message_content(context.bot, message, header, **send_kwargs)
+            sent_pairs   = [(message, sent_message)] if sent_message else []
+        for original, sent in sent_pairs:
             await db.save_mapping(
-                user_chat_id, message.message_id, sent_message.message_id, ticket_id
+                user_chat_id, original.message_id, sent.message_id, ticket_id
+            )
+        # К альбому клавиатуру не прикрепить: отправляем её следом отдельным сообщением
+        if album_markup is not None:
+            await context.bot.send_message(
+                text=f"🎫 Тикет #{ticket_id}", reply_markup=album_markup, **send_kwargs
             )
     except Exception as e:
         logger.error(f"Ошибка при пересылке сообщения: {e}")
@@ -261,174 +460,145 @@ async def forward_to_support(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def reply_from_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
-    if message.chat_id != db.SUPPORT_CHAT_ID or not message.reply_to_message:
-        return
-
     found = await db.find_user_by_support_message(message.reply_to_message.message_id)
     if not found:
         return
 
     user_chat_id, user_message_id, ticket_id = found
 
-    if await db.is_user_blocked(user_chat_id):
+    if db.is_user_blocked(user_chat_id):
         await message.reply_text("⛔️ Этот пользователь заблокирован. Он не получит сообщение.")
         return
 
     try:
-        if message.photo:
-            await context.bot.send_photo(
-                chat_id=user_chat_id, photo=message.photo[-1].file_id, caption=message.caption or ""
-            )
-        elif message.video:
-            await context.bot.send_video(
-                chat_id=user_chat_id, video=message.video.file_id, caption=message.caption or ""
-            )
-        elif message.document:
-            await context.bot.send_document(
-                chat_id=user_chat_id, document=message.document.file_id, caption=message.caption or ""
-            )
-        elif message.voice:
-            await context.bot.send_voice(
-                chat_id=user_chat_id, voice=message.voice.file_id
-            )
-        elif message.audio:
-            await context.bot.send_audio(
-                chat_id=user_chat_id, audio=message.audio.file_id, caption=message.caption or ""
-            )
-        elif message.text:
-            await context.bot.send_message(chat_id=user_chat_id, text=message.text)
+        await send_message_content(context.bot, message, chat_id=user_chat_id)
     except Exception as e:
         logger.error(f"Ошибка при отправке ответа пользователю: {e}")
 
 
-# ── Кнопки под тикетами ──────────────────────────────────────────────────────
-
-async def support_action_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query    = update.callback_query
-    data     = query.data
-    admin_id = query.from_user.id
+# ── Шаблоны ──────────────────────────────────────────────────────────────────
 
-    # ── Шаблоны ──────────────────────────────────────────────────────────────
-    if data.startswith("templates_"):
-        _, ticket_id_s, user_chat_id_s = data.split("_")
-        ticket_id, user_chat_id = int(ticket_id_s), int(user_chat_id_s)
-        templates = await db.get_templates()
-        if not templates:
-            await query.answer("Шаблонов пока нет. Добавьте через /admin → Шаблоны.", show_alert=True)
-            return
-        buttons = [
-            [InlineKeyboardButton(t[1], callback_data=f"usetpl_{t[0]}_{ticket_id}_{user_chat_id}")]
-            for t in templates
-        ]
-        buttons.append([InlineKeyboardButton("❌ Отмена", callback_data=f"canceltpl_{ticket_id}_{user_chat_id}")])
-        await query.answer()
-        await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(buttons))
+async def _templates_action(query, context: ContextTypes.DEFAULT_TYPE, parts: list):
+    ticket_id, user_chat_id = int(parts[1]), int(parts[2])
+    templates = await db.get_templates()
+    if not templates:
+        await query.answer("Шаблонов пока нет. Добавьте через /admin → Шаблоны.", show_alert=True)
         return
-
-    if data.startswith("usetpl_"):
-        parts = data.split("_")
-        tpl_id, ticket_id, user_chat_id = int(parts[1]), int(parts[2]), int(parts[3])
-        templates = await db.get_templates()
-        tpl = next((t for t in templates if t[0] == tpl_id), None)
-        if tpl:
-            try:
-                await context.bot.send_message(chat_id=user_chat_id, text=tpl[2])
-                await query.answer("✅ Шаблон отправлен")
-            except Exception as e:
-                logger.error(f"Ошибка отправки шаблона: {e}")
-                await query.answer("❌ Ошибка отправки", show_alert=True)
+    buttons = [
+        [InlineKeyboardButton(t[1], callback_data=f"usetpl_{t[0]}_{ticket_id}_{user_chat_id}")]
+        for t in templates
+    ]
+    buttons.append([InlineKeyboardButton("❌ Отмена", callback_data=f"canceltpl_{ticket_id}_{user_chat_id}")])
+    await query.answer()
+    await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(buttons))
+
+async def _use_template_action(query, context: ContextTypes.DEFAULT_TYPE, parts: list):
+    tpl_id, ticket_id, user_chat_id = int(parts[1]), int(parts[2]), int(parts[3])
+    templates = await db.get_templates()
+    tpl = next((t for t in templates if t[0] == tpl_id), None)
+    if tpl:
         try:
-            await query.edit_message_reply_markup(
-                reply_markup=await get_ticket_keyboard(user_chat_id, ticket_id)
-            )
-        except Exception:
-            pass
-        return
+            await context.bot.send_message(chat_id=user_chat_id, text=tpl[2])
+            await query.answer("✅ Шаблон отправлен")
+        except Exception as e:
+            logger.error(f"Ошибка отправки шаблона: {e}")
+            await query.answer("❌ Ошибка отправки", show_alert=True)
+    try:
+        await query.edit_message_reply_markup(
+            reply_markup=await get_ticket_keyboard(user_chat_id, ticket_id)
+        )
+    except Exception:
+        pass
 
-    if data.startswith("canceltpl_"):
-        _, ticket_id_s, user_chat_id_s = data.split("_")
-        ticket_id, user_chat_id = int(ticket_id_s), int(user_chat_id_s)
-        await query.answer()
-        try:
-            await query.edit_message_reply_markup(
-                reply_markup=await get_ticket_keyboard(user_chat_id, ticket_id)
-            )
-        except Exception:
-            pass
-        return
+async def _cancel_template_action(query, context: ContextTypes.DEFAULT_TYPE, parts: list):
+    ticket_id, user_chat_id = int(parts[1]), int(parts[2])
+    await query.answer()
+    try:
+        await query.edit_message_reply_markup(
+            reply_markup=await get_ticket_keyboard(user_chat_id, ticket_id)
+        )
+    except Exception:
+        pass
 
-    # ── Блокировка ────────────────────────────────────────────────────────────
-    if data.startswith("block_user_"):
-        parts = data.split("_")
-        target_user_id, ticket_id = int(parts[2]), int(parts[3])
-        is_blocked_now = await db.toggle_user_block(target_user_id, admin_id)
-        await query.answer(
-            "❗️ Пользователь заблокирован" if is_blocked_now else "✅ Пользователь разблокирован",
-            show_alert=False,
+
+# ── Блокировка ───────────────────────────────────────────────────────────────
+
+async def _block_user_action(query, context: ContextTypes.DEFAULT_TYPE, parts: list):
+    target_user_id, ticket_id = int(parts[2]), int(parts[3])
+    is_blocked_now = await db.toggle_user_block(target_user_id, query.from_user.id)
+    await query.answer(
+        "❗️ Пользователь заблокирован" if is_blocked_now else "✅ Пользователь разблокирован",
+        show_alert=False,
+    )
+    # Статус читаем из БД: клавиатура этого сообщения могла устареть,
+    # если тикет закрывали или открывали кнопкой другого сообщения
+    try:
+        await query.edit_message_reply_markup(
+            reply_markup=await get_ticket_keyboard(target_user_id, ticket_id)
         )
-        try:
-            await query.edit_message_reply_markup(
-                reply_markup=await get_ticket_keyboard(target_user_id, ticket_id)
-            )
-        except Exception:
-            pass
+    except Exception:
+        pass
 
-    # ── Закрытие тикета ───────────────────────────────────────────────────────
-    elif data.startswith("close_ticket_"):
-        parts = data.split("_")
-        ticket_id, user_chat_id = int(parts[2]), int(parts[3])
-        ticket_info = await db.get_ticket_info(ticket_id)
 
-        if ticket_info and ticket_info[4] != TicketStatus.CLOSED:
-            await db.update_ticket_status(ticket_id, TicketStatus.CLOSED)
-            await update_topic_status(context, ticket_id, TicketStatus.CLOSED)
-            try:
-                await context.bot.send_message(
-                    chat_id=user_chat_id,
-                    text="✅ Обращение завершено. Пожалуйста, оцените качество поддержки:",
-                    reply_markup=rating_keyboard(ticket_id),
-                )
-            except Exception:
-                pass
-            await query.answer("🔒 Тикет закрыт")
-        else:
-            await query.answer("Этот тикет уже закрыт")
+# ── Закрытие / открытие тикета ───────────────────────────────────────────────
 
-        try:
-            await query.edit_message_reply_markup(
-                reply_markup=await get_ticket_keyboard(user_chat_id, ticket_id)
-            )
-        except Exception:
-            pass
+async def _close_ticket_action(query, context: ContextTypes.DEFAULT_TYPE, parts: list):
+    ticket_id, user_chat_id = int(parts[2]), int(parts[3])
+    ticket_info = await db.get_ticket_info(ticket_id)
 
-    # ── Открытие тикета ───────────────────────────────────────────────────────
-    elif data.startswith("reopen_ticket_"):
-        parts = data.split("_")
-        ticket_id, user_chat_id = int(parts[2]), int(parts[3])
-        ticket_info = await db.get_ticket_info(ticket_id)
+    if ticket_info and ticket_info[4] != TicketStatus.CLOSED:
+        await db.update_ticket_status(ticket_id, TicketStatus.CLOSED)
+        queue_topic_status(ticket_id, TicketStatus.CLOSED, ticket_info)
+        # Независимые запросы к Telegram отправляем одновременно
+        results = await asyncio.gather(
+            context.bot.send_message(
+                chat_id=user_chat_id,
+                text="✅ Обращение завершено. Пожалуйста, оцените качество поддержки:",
+                reply_markup=rating_keyboard(ticket_id),
+            ),
+            query.answer("🔒 Тикет закрыт"),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка при закрытии тикета #{ticket_id}: {result}")
+    else:
+        await query.answer("Этот тикет уже закрыт")
 
-        if ticket_info and ticket_info[4] != TicketStatus.OPEN:
-            await db.update_ticket_status(ticket_id, TicketStatus.OPEN)
-            await update_topic_status(context, ticket_id, TicketStatus.OPEN)
-            await query.answer("🔓 Тикет открыт")
-        else:
-            await query.answer("Этот тикет уже открыт")
+    # После обработки статус известен, повторно читать тикет не нужно
+    status = TicketStatus.CLOSED if ticket_info else None
+    try:
+        await query.edit_message_reply_markup(
+            reply_markup=await get_ticket_keyboard(user_chat_id, ticket_id, status)
+        )
+    except Exception:
+        pass
 
-        try:
-            await query.edit_message_reply_markup(
-                reply_markup=await get_ticket_keyboard(user_chat_id, ticket_id)
-            )
-        except Exception:
-            pass
+async def _reopen_ticket_action(query, context: ContextTypes.DEFAULT_TYPE, parts: list):
+    ticket_id, user_chat_id = int(parts[2]), int(parts[3])
+    ticket_info = await db.get_ticket_info(ticket_id)
+
+    if ticket_info and ticket_info[4] != TicketStatus.OPEN:
+        await db.update_ticket_status(ticket_id, TicketStatus.OPEN)
+        queue_topic_status(ticket_id, TicketStatus.OPEN, ticket_info)
+        await query.answer("🔓 Тикет открыт")
+    else:
+        await query.answer("Этот тикет уже открыт")
+
+    status = TicketStatus.OPEN if ticket_info else None
+    try:
+        await query.edit_message_reply_markup(
+            reply_markup=await get_ticket_keyboard(user_chat_id, ticket_id, status)
+        )
+    except Exception:
+        pass
 
 
 # ── Оценка тикета ────────────────────────────────────────────────────────────
 
-async def rating_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query   = update.callback_query
-    _, ticket_id_s, rating_s = query.data.split("_")
-    ticket_id    = int(ticket_id_s)
-    rating       = int(rating_s)
+async def _rate_action(query, context: ContextTypes.DEFAULT_TYPE, parts: list):
+    ticket_id    = int(parts[1])
+    rating       = int(parts[2])
     user_chat_id = query.from_user.id
 
     existing = await db.get_rating(ticket_id)
@@ -452,7 +622,7 @@ async def rating_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if ticket_info:
             topic_id = ticket_info[0]
             msg_kwargs = {"chat_id": db.SUPPORT_CHAT_ID, "text": f"⭐ Тикет #{ticket_id} оценён: {stars_str} ({rating}/5)"}
-            if topic_id and await db.get_topic_mode() == TopicMode.PER_USER:
+            if topic_id and db.get_topic_mode() == TopicMode.PER_USER:
                 msg_kwargs["message_thread_id"] = topic_id
             elif db.SUPPORT_TOPIC_ID:
                 msg_kwargs["message_thread_id"] = db.SUPPORT_TOPIC_ID
@@ -461,29 +631,44 @@ async def rating_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка уведомления об оценке: {e}")
 
 
+# ── Диспетчер callback-кнопок ────────────────────────────────────────────────
+
+# Первая часть callback_data (до "_") -> обработчик
+CALLBACK_ACTIONS = {
+    "templates": _templates_action,
+    "usetpl":    _use_template_action,
+    "canceltpl": _cancel_template_action,
+    "block":     _block_user_action,
+    "close":     _close_ticket_action,
+    "reopen":    _reopen_ticket_action,
+    "rate":      _rate_action,
+}
+CALLBACK_ACTIONS_PATTERN = re.compile(rf"^({'|'.join(CALLBACK_ACTIONS)})_")
+
+async def callback_dispatcher(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    parts = query.data.split("_")
+    await CALLBACK_ACTIONS[parts[0]](query, context, parts)
+
+
 # ── Команды чата поддержки ───────────────────────────────────────────────────
 
 async def open_tickets_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.chat_id != db.SUPPORT_CHAT_ID:
-        return
     rows = await db.get_all_open_tickets()
     if not rows:
         await update.message.reply_text("Открытых тикетов нет ✅")
         return
-    lines = ["📂 Открытые тикеты:\n"]
-    for ticket_id, user_chat_id, username, first_name, created_at, updated_at in rows:
-        lines.append(
-            f"🎫 Тикет #{ticket_id}\n"
-            f"👤 {first_name or 'Не указано'}\n"
-            f"📱 {'@' + username if username else 'Не указан'}\n"
-            f"🆔 ID: {user_chat_id}\n"
-            f"📅 Создан: {db.format_datetime(created_at)}\n"
-        )
-    await update.message.reply_text("\n".join(lines))
+    text = "📂 Открытые тикеты:\n\n" + "\n".join(
+        f"🎫 Тикет #{ticket_id}\n"
+        f"👤 {first_name or 'Не указано'}\n"
+        f"📱 {'@' + username if username else 'Не указан'}\n"
+        f"🆔 ID: {user_chat_id}\n"
+        f"📅 Создан: {created_at}\n"
+        for ticket_id, user_chat_id, username, first_name, created_at, updated_at in rows
+    )
+    await update.message.reply_text(text)
 
 async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.chat_id != db.SUPPORT_CHAT_ID and not db.is_admin(update.effective_user.id):
-        return
     s = await db.get_stats()
     rating_str = (
         f"{s['avg_rating']} ⭐ ({s['ratings_count']} оценок)"
@@ -505,38 +690,114 @@ async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ── Error handler ─────────────────────────────────────────────────────────────
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.error(f"Update {update} caused error {context.error}")
+    # Трейсбек форматируется только если запись действительно будет выведена
+    logger.error(
+        "handler error on update_id=%s", getattr(update, "update_id", None),
+        exc_info=context.error,
+    )
 
 
 # ── main ─────────────────────────────────────────────────────────────────────
 
+class OrjsonRequest(HTTPXRequest):
+    """HTTPXRequest, разбирающий ответы Telegram через orjson вместо json."""
+
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # orjson строже json: не принимает битый UTF-8 и одиночные суррогаты
+            # ("\ud83d"). Такой ответ разбираем стандартно, иначе polling застрянет
+            # на одном offset. TelegramError поднимет только он.
+            return HTTPXRequest.parse_json_payload(payload)
+
+class PerSenderUpdateProcessor(SimpleUpdateProcessor):
+    """Апдейты одного отправителя в одном чате обрабатываются строго по порядку,
+    апдейты разных отправителей — параллельно.
+
+    Так ответы оператора пользователю и шаги диалога /admin не обгоняют друг друга.
+    Очередной апдейт ждёт предыдущий того же отправителя до того, как занять
+    слот семафора, поэтому поток апдейтов от одного человека не забирает
+    все max_concurrent_updates слотов у остальных чатов.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # (chat_id, user_id) -> задача последнего апдейта этого отправителя
+        self._sender_tails: dict[tuple, asyncio.Task] = {}
+
+    async def process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        user = getattr(update, "effective_user", None)
+        if chat is None and user is None:
+            await super().process_update(update, coroutine)
+            return
+        key      = (chat and chat.id, user and user.id)
+        previous = self._sender_tails.get(key)
+        task     = self._sender_tails[key] = asyncio.current_task()
+        try:
+            if previous is not None:
+                # wait() не пробрасывает исключения и отмену предыдущего апдейта
+                await asyncio.wait((previous,))
+            await super().process_update(update, coroutine)
+        except asyncio.CancelledError:
+            coroutine.close()
+            raise
+        finally:
+            if self._sender_tails.get(key) is task:
+                del self._sender_tails[key]
+
 async def post_init(application: Application):
+    global _topic_worker_task
     await db.init_db()
+    _topic_worker_task = asyncio.create_task(_topic_worker(application))
+
+async def post_shutdown(application: Application):
+    if _topic_worker_task is not None:
+        _topic_worker_task.cancel()
+    await db.close_db()
 
 def main():
+    _log_listener.start()
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(_log_queue))
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     application = (
         Application.builder()
         .token(db.TOKEN)
+        .request(OrjsonRequest(connection_pool_size=256, pool_timeout=20))
+        .get_updates_request(OrjsonRequest(connection_pool_size=16, pool_timeout=30))
+        .concurrent_updates(PerSenderUpdateProcessor(32))
+        .rate_limiter(
+            AIORateLimiter(
+                overall_max_rate=28,
+                overall_time_period=1,
+                group_max_rate=19,
+                group_time_period=60,
+                max_retries=2,
+            )
+        )
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
+    # Проверки чата и прав выполняются фильтрами ещё до запуска хендлера
+    support_chat = filters.Chat(db.SUPPORT_CHAT_ID)
+    admins       = filters.User(db.ADMINS)
+
     application.add_handler(CommandHandler("start",        start))
     application.add_handler(CommandHandler("help",         help_command))
-    application.add_handler(CommandHandler("admin",        admin_command))
-    application.add_handler(CommandHandler("open_tickets", open_tickets_cmd))
-    application.add_handler(CommandHandler("stats",        stats_cmd))
+    application.add_handler(CommandHandler("admin",        admin_command,    filters=admins))
+    application.add_handler(CommandHandler("open_tickets", open_tickets_cmd, filters=support_chat))
+    application.add_handler(CommandHandler("stats",        stats_cmd,        filters=support_chat | admins))
 
     application.add_handler(get_admin_conv_handler())
 
     application.add_handler(
-        CallbackQueryHandler(rating_callback, pattern=r"^rate_\d+_\d+$")
-    )
-    application.add_handler(
-        CallbackQueryHandler(
-            support_action_callback,
-            pattern=r"^(block_user_|close_ticket_|reopen_ticket_|templates_|usetpl_|canceltpl_)",
-        )
+        CallbackQueryHandler(callback_dispatcher, pattern=CALLBACK_ACTIONS_PATTERN)
     )
 
     application.add_handler(
@@ -545,11 +806,23 @@ def main():
             forward_to_support,
         )
     )
-    application.add_handler(MessageHandler(filters.REPLY, reply_from_support))
+    application.add_handler(
+        MessageHandler(
+            support_chat & filters.REPLY & ~filters.COMMAND,
+            reply_from_support,
+        )
+    )
     application.add_error_handler(error_handler)
 
     logger.info("Bot started")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        application.run_polling(
+            timeout=30,
+            poll_interval=0.0,
+            allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY],
+        )
+    finally:
+        _log_listener.stop()
 
 if __name__ == "__main__":
     main()
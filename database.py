@@ -1,5 +1,8 @@
+import asyncio
 import logging
 import os
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 from enum import Enum
 
@@ -16,10 +19,13 @@ SUPPORT_CHAT_ID = int(os.getenv("SUPPORT_CHAT_ID", "0"))
 raw_topic_id = os.getenv("SUPPORT_TOPIC_ID")
 SUPPORT_TOPIC_ID = int(raw_topic_id) if raw_topic_id and raw_topic_id.strip().isdigit() else None
 
-ADMINS = [int(admin_id.strip()) for admin_id in os.getenv("ADMINS", "").split(",") if admin_id.strip()]
+ADMINS: frozenset[int] = frozenset(
+    int(admin_id.strip()) for admin_id in os.getenv("ADMINS", "").split(",") if admin_id.strip()
+)
 
 MSK = pytz.timezone("Europe/Moscow")
 DB_PATH = "support_bot.db"
+READ_POOL_SIZE = 4
 
 
 # ── Константы вместо «магических строк» ──────────────────────────────────────
@@ -52,10 +58,62 @@ DEFAULT_WORK_TEXT = "💤 На данный момент мы не работа
 DEFAULT_WORK_TIME = "10:00-18:00"
 
 
+# ── Пул соединений ───────────────────────────────────────────────────────────
+# Одно соединение на запись (SQLite допускает только одного писателя)
+# и пул соединений на чтение, чтобы запросы разных хендлеров шли параллельно.
+
+_writer: aiosqlite.Connection | None = None
+_write_lock = asyncio.Lock()
+_readers: asyncio.Queue | None = None
+
+# Кэш заблокированных пользователей: все изменения идут через этот процесс
+BLOCKED: set[int] = set()
+
+# Кэш настроек бота, обновляется в set_setting()
+SETTINGS: dict[str, str] = {}
+
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+)
+
+async def _connect() -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(DB_PATH, cached_statements=256)
+    for pragma in _PRAGMAS:
+        await conn.execute(pragma)
+    return conn
+
+@asynccontextmanager
+async def _read():
+    conn = await _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put_nowait(conn)
+
+@asynccontextmanager
+async def _write():
+    async with _write_lock:
+        try:
+            yield _writer
+        except BaseException:
+            # Соединение общее: незавершённая транзакция не должна попасть
+            # в commit() следующего писателя
+            if _writer is not None:
+                await _writer.rollback()
+            raise
+
+
 # ── Инициализация БД ─────────────────────────────────────────────────────────
 
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
+    global _writer, _readers
+    _writer = await _connect()
+    async with _write() as db:
         await db.executescript("""
         CREATE TABLE IF NOT EXISTS messages_mapping (
             user_chat_id       INTEGER,
@@ -116,23 +174,52 @@ async def init_db():
             await db.execute("ALTER TABLE blocked_users ADD COLUMN reason TEXT")
             logger.info("Добавлена колонка reason в таблицу blocked_users")
 
+        # Индексы для частых выборок
+        await db.executescript("""
+        CREATE INDEX IF NOT EXISTS idx_mapping_support_msg_cover
+            ON messages_mapping(support_message_id, user_chat_id, user_message_id, ticket_id);
+        CREATE INDEX IF NOT EXISTS idx_tickets_user_status
+            ON tickets(user_chat_id, status, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_tickets_status_updated
+            ON tickets(status, updated_at DESC);
+        """)
+
         await db.commit()
 
+        async with db.execute("SELECT user_chat_id FROM blocked_users") as cur:
+            BLOCKED.update([row[0] async for row in cur])
+
+        async with db.execute("SELECT setting_key, setting_value FROM bot_settings") as cur:
+            SETTINGS.update({row[0]: row[1] async for row in cur})
+
+    _readers = asyncio.Queue()
+    for _ in range(READ_POOL_SIZE):
+        _readers.put_nowait(await _connect())
+
+async def close_db():
+    global _writer, _readers
+    if _mapping_flush_task is not None:
+        _mapping_flush_task.cancel()
+    try:
+        await flush_mappings()
+    except Exception as e:
+        logger.error(f"Ошибка сохранения маппинга сообщений: {e}")
+    if _readers is not None:
+        while not _readers.empty():
+            await _readers.get_nowait().close()
+        _readers = None
+    # Под блокировкой: дожидаемся записи, которая могла уже начаться
+    async with _write_lock:
+        if _writer is not None:
+            await _writer.close()
+            _writer = None
+
 
 # ── Утилиты ──────────────────────────────────────────────────────────────────
 
 def _now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
-def format_datetime(iso_string: str) -> str:
-    try:
-        dt = datetime.fromisoformat(iso_string)
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=timezone.utc)
-        return dt.astimezone(MSK).strftime("%d.%m.%Y %H:%M")
-    except Exception:
-        return iso_string
-
 def is_admin(user_id: int) -> bool:
     return user_id in ADMINS
 
@@ -170,24 +257,20 @@ def validate_time_range(time_str: str) -> bool:
 
 # ── Настройки ────────────────────────────────────────────────────────────────
 
-async def get_setting(key: str, default: str = "") -> str:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT setting_value FROM bot_settings WHERE setting_key = ?", (key,)
-        ) as cur:
-            row = await cur.fetchone()
-    return row[0] if row else default
+def get_setting(key: str, default: str = "") -> str:
+    return SETTINGS.get(key, default)
 
 async def set_setting(key: str, value: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         await db.execute(
             "INSERT OR REPLACE INTO bot_settings (setting_key, setting_value) VALUES (?, ?)",
             (key, value),
         )
         await db.commit()
+    SETTINGS[key] = value
 
-async def get_topic_mode() -> str:
-    return await get_setting("topic_mode", TopicMode.PER_USER)
+def get_topic_mode() -> str:
+    return get_setting("topic_mode", TopicMode.PER_USER)
 
 async def set_topic_mode(mode: str):
     await set_setting("topic_mode", mode)
@@ -195,24 +278,16 @@ async def set_topic_mode(mode: str):
 
 # ── Пользователи / блокировки ────────────────────────────────────────────────
 
-async def is_user_blocked(user_chat_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT 1 FROM blocked_users WHERE user_chat_id = ?", (user_chat_id,)
-        ) as cur:
-            return await cur.fetchone() is not None
+def is_user_blocked(user_chat_id: int) -> bool:
+    return user_chat_id in BLOCKED
 
 async def toggle_user_block(user_chat_id: int, admin_id: int, reason: str = "") -> bool:
     """Возвращает True если пользователь теперь заблокирован."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT 1 FROM blocked_users WHERE user_chat_id = ?", (user_chat_id,)
-        ) as cur:
-            blocked = await cur.fetchone() is not None
-
-        if blocked:
+    async with _write() as db:
+        if user_chat_id in BLOCKED:
             await db.execute("DELETE FROM blocked_users WHERE user_chat_id = ?", (user_chat_id,))
             await db.commit()
+            BLOCKED.discard(user_chat_id)
             return False
         else:
             await db.execute(
@@ -220,13 +295,14 @@ async def toggle_user_block(user_chat_id: int, admin_id: int, reason: str = "")
                 (user_chat_id, _now_iso(), admin_id, reason),
             )
             await db.commit()
+            BLOCKED.add(user_chat_id)
             return True
 
 
 # ── Тикеты ───────────────────────────────────────────────────────────────────
 
 async def get_open_ticket(user_chat_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _read() as db:
         async with db.execute(
             "SELECT id, topic_id FROM tickets WHERE user_chat_id = ? AND status = 'open' ORDER BY id DESC LIMIT 1",
             (user_chat_id,),
@@ -235,17 +311,18 @@ async def get_open_ticket(user_chat_id: int):
 
 async def create_ticket_in_db(user_chat_id: int, username: str, first_name: str, topic_id: int) -> int:
     now = _now_iso()
-    async with aiosqlite.connect(DB_PATH) as db:
+    # lastrowid надёжен: единственный писатель работает под _write_lock
+    async with _write() as db:
         cur = await db.execute(
             "INSERT INTO tickets (user_chat_id, username, first_name, status, created_at, updated_at, topic_id) "
             "VALUES (?, ?, ?, 'open', ?, ?, ?)",
             (user_chat_id, username, first_name, now, now, topic_id),
         )
         await db.commit()
-        return cur.lastrowid
+    return cur.lastrowid
 
 async def update_ticket_status(ticket_id: int, status: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         await db.execute(
             "UPDATE tickets SET status = ?, updated_at = ? WHERE id = ?",
             (status, _now_iso(), ticket_id),
@@ -253,7 +330,7 @@ async def update_ticket_status(ticket_id: int, status: str):
         await db.commit()
 
 async def get_ticket_info(ticket_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _read() as db:
         async with db.execute(
             "SELECT topic_id, username, first_name, user_chat_id, status, created_at, updated_at "
             "FROM tickets WHERE id = ?",
@@ -262,16 +339,19 @@ async def get_ticket_info(ticket_id: int):
             return await cur.fetchone()
 
 async def get_all_open_tickets(limit: int = 50):
-    async with aiosqlite.connect(DB_PATH) as db:
+    """Даты возвращаются уже отформатированными по МСК (UTC+3), нераспознанные — как есть."""
+    async with _read() as db:
         async with db.execute(
-            "SELECT id, user_chat_id, username, first_name, created_at, updated_at "
+            "SELECT id, user_chat_id, username, first_name, "
+            "COALESCE(strftime('%d.%m.%Y %H:%M', created_at, '+3 hours'), created_at), "
+            "COALESCE(strftime('%d.%m.%Y %H:%M', updated_at, '+3 hours'), updated_at) "
             "FROM tickets WHERE status = 'open' ORDER BY updated_at DESC LIMIT ?",
             (limit,),
         ) as cur:
             return await cur.fetchall()
 
 async def get_user_chat_id_by_ticket(ticket_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _read() as db:
         async with db.execute(
             "SELECT user_chat_id FROM tickets WHERE id = ?", (ticket_id,)
         ) as cur:
@@ -281,29 +361,88 @@ async def get_user_chat_id_by_ticket(ticket_id: int):
 
 # ── Маппинг сообщений ────────────────────────────────────────────────────────
 
+# Маппинги копятся в буфере и пишутся одной транзакцией: альбомы и серии
+# сообщений дают одну запись на диск вместо отдельного коммита на каждое.
+
+MAPPING_FLUSH_DELAY = 0.2  # секунд
+MAPPING_FLUSH_SIZE  = 50
+
+_mapping_buffer: list[tuple] = []
+_mapping_flush_task: asyncio.Task | None = None
+
+# Недавние маппинги по support_message_id: операторы почти всегда отвечают
+# на свежие сообщения, часто по нескольку раз на одно и то же
+RECENT_MAPPINGS_SIZE = 1024
+_recent_mappings: OrderedDict[int, tuple] = OrderedDict()
+
+def _remember_mapping(support_message_id, found: tuple):
+    _recent_mappings[support_message_id] = found
+    _recent_mappings.move_to_end(support_message_id)
+    if len(_recent_mappings) > RECENT_MAPPINGS_SIZE:
+        _recent_mappings.popitem(last=False)
+
 async def save_mapping(user_chat_id, user_message_id, support_message_id, ticket_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT OR REPLACE INTO messages_mapping "
-            "(user_chat_id, user_message_id, support_message_id, ticket_id) VALUES (?, ?, ?, ?)",
-            (user_chat_id, user_message_id, support_message_id, ticket_id),
-        )
-        await db.commit()
+    global _mapping_flush_task
+    _mapping_buffer.append((user_chat_id, user_message_id, support_message_id, ticket_id))
+    _remember_mapping(support_message_id, (user_chat_id, user_message_id, ticket_id))
+    if len(_mapping_buffer) >= MAPPING_FLUSH_SIZE:
+        try:
+            await flush_mappings()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения маппинга сообщений: {e}")
+    elif _mapping_flush_task is None:
+        _mapping_flush_task = asyncio.create_task(_delayed_flush())
+
+async def _delayed_flush():
+    global _mapping_flush_task
+    await asyncio.sleep(MAPPING_FLUSH_DELAY)
+    _mapping_flush_task = None
+    try:
+        await flush_mappings()
+    except Exception as e:
+        logger.error(f"Ошибка сохранения маппинга сообщений: {e}")
+
+async def flush_mappings():
+    async with _write() as db:
+        # Буфер забираем только под блокировкой записи: при ошибке строки
+        # возвращаются обратно и уйдут со следующей записью
+        if db is None or not _mapping_buffer:
+            return
+        rows = _mapping_buffer.copy()
+        _mapping_buffer.clear()
+        try:
+            await db.executemany(
+                "INSERT OR REPLACE INTO messages_mapping "
+                "(user_chat_id, user_message_id, support_message_id, ticket_id) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            await db.commit()
+        except Exception:
+            _mapping_buffer[:0] = rows
+            raise
 
 async def find_user_by_support_message(support_message_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+    # Сюда же попадают маппинги, ещё не записанные из буфера
+    found = _recent_mappings.get(support_message_id)
+    if found is not None:
+        _recent_mappings.move_to_end(support_message_id)
+        return found
+    async with _read() as db:
         async with db.execute(
             "SELECT user_chat_id, user_message_id, ticket_id FROM messages_mapping "
             "WHERE support_message_id = ?",
             (support_message_id,),
         ) as cur:
-            return await cur.fetchone()
+            found = await cur.fetchone()
+    if found is not None:
+        _remember_mapping(support_message_id, tuple(found))
+    return found
 
 
 # ── Рейтинги ─────────────────────────────────────────────────────────────────
 
 async def save_rating(ticket_id: int, user_chat_id: int, rating: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         await db.execute(
             "INSERT OR REPLACE INTO ticket_ratings (ticket_id, user_chat_id, rating, rated_at) "
             "VALUES (?, ?, ?, ?)",
@@ -312,7 +451,7 @@ async def save_rating(ticket_id: int, user_chat_id: int, rating: int):
         await db.commit()
 
 async def get_rating(ticket_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _read() as db:
         async with db.execute(
             "SELECT rating FROM ticket_ratings WHERE ticket_id = ?", (ticket_id,)
         ) as cur:
@@ -323,20 +462,20 @@ async def get_rating(ticket_id: int):
 # ── Шаблоны ответов ──────────────────────────────────────────────────────────
 
 async def get_templates():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _read() as db:
         async with db.execute("SELECT id, title, content FROM templates ORDER BY id") as cur:
             return await cur.fetchall()
 
 async def add_template(title: str, content: str) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         cur = await db.execute(
             "INSERT INTO templates (title, content) VALUES (?, ?)", (title, content)
         )
         await db.commit()
-        return cur.lastrowid
+    return cur.lastrowid
 
 async def delete_template(template_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         await db.execute("DELETE FROM templates WHERE id = ?", (template_id,))
         await db.commit()
 
@@ -344,7 +483,7 @@ async def delete_template(template_id: int):
 # ── Статистика ───────────────────────────────────────────────────────────────
 
 async def get_stats() -> dict:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _read() as db:
         async with db.execute("SELECT COUNT(*) FROM tickets") as cur:
             total = (await cur.fetchone())[0]
 